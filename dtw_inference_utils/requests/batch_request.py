@@ -8,14 +8,15 @@ import asyncio  # for running API calls concurrently
 import json  # for saving results to a jsonl file
 import logging  # for logging rate limit warnings and other messages
 import os  # for reading API key
-from typing import List
+from typing import Callable, List, Union
 
 from dtw_inference_utils.requests.constants import get_limits
 
-from dtw_inference_utils.requests.status import StatusTracker, RateLimitStatus
+from dtw_inference_utils.requests.status import StatusTracker, RateLimitStatus, ConcurrencyLimitStatus
 from dtw_inference_utils.requests.request import APIRequest
 
 from dtw_inference_utils.requests.rate_limits import num_tokens_consumed_from_request
+from dtw_inference_utils.requests.token_counters import TokenCounter
 from dtw_inference_utils.requests.utils import api_endpoint_from_url, task_id_generator_function
 
 
@@ -26,8 +27,20 @@ async def process_api_batch_request(
         model_name: str = "gpt-3.5-turbo",
         max_attempts: int = 5,
         max_requests_per_minute: int = None,
+        max_tokens_per_minute: int = None,
+        token_counter: Union[str, TokenCounter] = None,
+        adaptive_concurrency: bool = False,
+        initial_concurrency: int = 16,
+        max_concurrency: int = 1024,
+        response_handler: Callable[[dict, dict, dict], None] = None,
 ):
-    """Processes API requests in parallel, throttling to stay under rate limits."""
+    """Processes API requests in parallel, throttling to stay under rate limits.
+
+    Successful responses are saved to `save_filepath`, or passed to `response_handler` if given.
+    Requests may contain a precomputed "token_consumption", which is removed before sending them.
+    With `adaptive_concurrency`, the rate limits are ignored and the number of requests in flight is adapted
+    to the observed latency instead, see `ConcurrencyLimitStatus`.
+    """
     # constants
     seconds_to_pause_after_rate_limit_error = 15
     seconds_to_sleep_each_loop = 0.001  # 1 ms limits max throughput to 1,000 requests per second
@@ -37,10 +50,13 @@ async def process_api_batch_request(
     api_key = os.getenv("OPENAI_API_KEY")
     request_header = {"Authorization": f"Bearer {api_key}"}
 
+    default_requests_per_minute, default_tokens_per_minute, token_encoding_name = get_limits(model_name)
     if max_requests_per_minute is None:
-        max_requests_per_minute, max_tokens_per_minute, token_encoding_name = get_limits(model_name)
-    else:
-        _, max_tokens_per_minute, token_encoding_name = get_limits(model_name)
+        max_requests_per_minute = default_requests_per_minute
+    if max_tokens_per_minute is None:
+        max_tokens_per_minute = default_tokens_per_minute
+    if token_counter is None:
+        token_counter = token_encoding_name
 
     # initialize trackers
     queue_of_requests_to_retry = asyncio.Queue()
@@ -49,10 +65,14 @@ async def process_api_batch_request(
     next_request = None  # variable to hold the next request to call
 
     # initialize available capacity counts
-
-    rate_limit_status = RateLimitStatus(
-        max_requests_per_minute=max_requests_per_minute, max_tokens_per_minute=max_tokens_per_minute
-    )
+    concurrency_limit_status = None
+    if adaptive_concurrency:
+        concurrency_limit_status = ConcurrencyLimitStatus(initial_limit=initial_concurrency, max_limit=max_concurrency)
+        rate_limit_status = concurrency_limit_status
+    else:
+        rate_limit_status = RateLimitStatus(
+            max_requests_per_minute=max_requests_per_minute, max_tokens_per_minute=max_tokens_per_minute
+        )
 
     # initialize flags
     file_not_finished = True  # after file is empty, we'll skip reading it
@@ -63,7 +83,9 @@ async def process_api_batch_request(
 
     requests_iter = request_batch.__iter__()
     logging.debug(f"File opened. Entering main loop")
-    async with aiohttp.ClientSession() as session:  # Initialize ClientSession here
+    # the default connection pool would queue requests on our side and hide the backend's latency
+    connector = aiohttp.TCPConnector(limit=max_concurrency) if adaptive_concurrency else None
+    async with aiohttp.ClientSession(connector=connector) as session:  # Initialize ClientSession here
         while True:
             # get next request (if one is not already waiting for capacity)
             if next_request is None:
@@ -74,12 +96,16 @@ async def process_api_batch_request(
                     try:
                         # get new request
                         request_json = next(requests_iter)
+                        # requests may bring their token count along, e.g. packed embedding requests
+                        token_consumption = request_json.pop("token_consumption", None)
+                        if token_consumption is None:
+                            token_consumption = 0 if adaptive_concurrency else num_tokens_consumed_from_request(
+                                request_json, api_endpoint, token_counter
+                            )
                         next_request = APIRequest(
                             task_id=next(task_id_generator),
                             request_json=request_json,
-                            token_consumption=num_tokens_consumed_from_request(
-                                request_json, api_endpoint, token_encoding_name
-                            ),
+                            token_consumption=token_consumption,
                             attempts_left=max_attempts,
                             metadata=request_json.pop("metadata", None),
                         )
@@ -112,6 +138,8 @@ async def process_api_batch_request(
                             retry_queue=queue_of_requests_to_retry,
                             save_filepath=save_filepath,
                             status_tracker=status_tracker,
+                            concurrency_limit_status=concurrency_limit_status,
+                            response_handler=response_handler,
                         )
                     )
                     next_request = None  # reset next_request to empty
@@ -140,6 +168,9 @@ async def process_api_batch_request(
     # after finishing, log final status
     logging.info(f"""Parallel processing complete. Results saved to {save_filepath}""")
 
+    if concurrency_limit_status is not None:
+        logging.info(f"Final concurrency limit: {int(concurrency_limit_status.limit)} requests in flight")
+
     if status_tracker.num_tasks_failed > 0:
         logging.warning(
             f"{status_tracker.num_tasks_failed} / {status_tracker.num_tasks_started} requests failed. Errors logged to {save_filepath}."
@@ -157,7 +188,12 @@ def batch_request(
         model_name: str = "gpt-3.5-turbo",
         request_url: str = "https://api.openai.com/v1/chat/completions",
         max_attempts: int = 5,
-        max_requests_per_minute: int = None
+        max_requests_per_minute: int = None,
+        max_tokens_per_minute: int = None,
+        token_counter: Union[str, TokenCounter] = None,
+        adaptive_concurrency: bool = False,
+        initial_concurrency: int = 16,
+        max_concurrency: int = 1024,
 ):
     """Processes API requests in parallel, throttling to stay under rate limits.
     
@@ -171,6 +207,15 @@ def batch_request(
         cache_dir: Directory to save results to, defaults to "cache" in current working directory.
         model_name: Name of the model to use, defaults to "gpt-3.5-turbo".
         max_attempts: Maximum number of attempts to make per request.
+        max_requests_per_minute: Request limit, defaults to the model's limit from `limits_dict`.
+        max_tokens_per_minute: Token limit, defaults to the model's limit from `limits_dict`.
+        token_counter: Tiktoken encoding name, HuggingFace tokenizer path or TokenCounter used to count the
+            tokens of each request. Defaults to the tiktoken encoding of OpenAI models and to `model_name` as
+            tokenizer path otherwise.
+        adaptive_concurrency: Ignore the rate limits and adapt the number of requests in flight to the observed
+            latency instead. Meant for self-hosted backends without rate limits, e.g. vllm.
+        initial_concurrency: Number of requests in flight to start with if `adaptive_concurrency` is set.
+        max_concurrency: Upper bound for the number of requests in flight if `adaptive_concurrency` is set.
     """
     os.makedirs(cache_dir, exist_ok=True)
 
@@ -188,7 +233,12 @@ def batch_request(
             request_url=request_url,
             model_name=model_name,
             max_attempts=max_attempts,
-            max_requests_per_minute=max_requests_per_minute
+            max_requests_per_minute=max_requests_per_minute,
+            max_tokens_per_minute=max_tokens_per_minute,
+            token_counter=token_counter,
+            adaptive_concurrency=adaptive_concurrency,
+            initial_concurrency=initial_concurrency,
+            max_concurrency=max_concurrency,
         )
     )
     results = []
@@ -0,0 +1,195 @@
+import asyncio
+import base64
+import logging
+import os
+import time
+from typing import Iterator, List, Union
+
+import numpy as np
+
+from dtw_inference_utils.requests.batch_request import process_api_batch_request
+from dtw_inference_utils.requests.constants import get_limits
+from dtw_inference_utils.requests.token_counters import TokenCounter, get_token_counter
+
+
+def pack_embedding_requests(
+        texts: List[str],
+        model_name: str,
+        token_counter: TokenCounter,
+        max_inputs_per_request: int = 2048,
+        max_tokens_per_request: int = 100000,
+        encoding_format: str = "float",
+) -> Iterator[dict]:
+    """Pack single texts into embedding requests with a list `input`, staying under both caps per request.
+
+    The position of each text in `texts` is its request_id, the request_ids of a request are stored in its metadata.
+    The token count of each request is passed along, so that the texts are not tokenized again. A single text with
+    more than `max_tokens_per_request` tokens is sent alone and counted as `max_tokens_per_request`, as it could never
+    be sent under a token rate limit of that size otherwise. The API rejects it anyway.
+    """
+    request_ids, inputs, num_tokens = [], [], 0
+
+    def make_request():
+        return {
+            "model": model_name,
+            "input": inputs,
+            "encoding_format": encoding_format,
+            "metadata": {"request_ids": request_ids},
+            "token_consumption": num_tokens,
+        }
+
+    for request_id, text in enumerate(texts):
+        text_tokens = min(token_counter.num_tokens(text), max_tokens_per_request)
+        if inputs and (
+                len(inputs) >= max_inputs_per_request or num_tokens + text_tokens > max_tokens_per_request
+        ):
+            yield make_request()
+            request_ids, inputs, num_tokens = [], [], 0
+        request_ids.append(request_id)
+        inputs.append(text)
+        num_tokens += text_tokens
+
+    if inputs:
+        yield make_request()
+
+
+class EmbeddingWriter:
+    """Writes the embeddings of packed responses into a .npy file, one row per request_id.
+
+    The file is preallocated as memmap, right away if `embedding_dim` is given, otherwise once the first response
+    tells the embedding dimension.
+    """
+
+    def __init__(self, save_filepath: str, num_embeddings: int, embedding_dim: int = None, dtype=np.float32):
+        self.save_filepath = save_filepath
+        self.num_embeddings = num_embeddings
+        self.dtype = dtype
+
+        self.embeddings = None
+        self.is_embedded = np.zeros(num_embeddings, dtype=bool)
+        if embedding_dim is not None:
+            self._allocate(embedding_dim)
+
+    def _allocate(self, embedding_dim: int):
+        self.embeddings = np.lib.format.open_memmap(
+            self.save_filepath, mode="w+", dtype=self.dtype, shape=(self.num_embeddings, embedding_dim)
+        )
+
+    def __call__(self, request_json: dict, response: dict, metadata: dict):
+        request_ids = metadata["request_ids"]
+        indices = sorted(item["index"] for item in response["data"])
+        if indices != list(range(len(request_ids))):
+            # raising fails the request, so it is retried instead of leaving rows silently empty
+            raise ValueError(f"Response has embeddings for indices {indices}, expected 0 to {len(request_ids) - 1}")
+        for item in response["data"]:
+            embedding = item["embedding"]
+            if isinstance(embedding, str):  # encoding_format "base64"
+                embedding = np.frombuffer(base64.b64decode(embedding), dtype=np.float32)
+            if self.embeddings is None:
+                self._allocate(len(embedding))
+            request_id = request_ids[item["index"]]
+            self.embeddings[request_id] = embedding
+            self.is_embedded[request_id] = True
+
+    def flush(self):
+        if self.embeddings is not None:
+            self.embeddings.flush()
+
+
+def batch_embed(
+        request_batch: List[Union[str, dict]],
+        cache_dir: str = os.path.join(os.getcwd(), "cache"),
+        model_name: str = "text-embedding-ada-002",
+        request_url: str = "https://api.openai.com/v1/embeddings",
+        max_attempts: int = 5,
+        max_requests_per_minute: int = None,
+        max_tokens_per_minute: int = None,
+        token_counter: Union[str, TokenCounter] = None,
+        max_inputs_per_request: int = 2048,
+        max_tokens_per_request: int = 100000,
+        encoding_format: str = "float",
+        embedding_dim: int = None,
+):
+    """Embeds many texts, packing them into few requests, and writes the embeddings to a .npy file.
+
+    Args:
+        request_batch: List of texts, or of jobs of the form {"input": text, "metadata": metadata}.
+        cache_dir: Directory to save results to, defaults to "cache" in current working directory.
+        model_name: Name of the model to use, defaults to "text-embedding-ada-002".
+        max_attempts: Maximum number of attempts to make per request.
+        max_requests_per_minute: Request limit, defaults to the model's limit from `limits_dict`.
+        max_tokens_per_minute: Token limit, defaults to the model's limit from `limits_dict`.
+        token_counter: Tiktoken encoding name, HuggingFace tokenizer path or TokenCounter, see `batch_request`.
+        max_inputs_per_request: Maximum number of texts per request.
+        max_tokens_per_request: Maximum number of tokens per request, lowered to the token limit if that is smaller.
+        encoding_format: "float" or "base64", the latter keeps responses much smaller.
+        embedding_dim: Dimension of the embeddings. If given, the .npy file is created before the first request,
+            otherwise from the first response.
+
+    Returns:
+        A dictionary with the keys "embeddings", a memmap with the embedding of request_id i in row i,
+        "request_ids", the request_ids that were embedded successfully, and "metadata", the jobs' metadata by
+        request_id. Rows of failed request_ids are zero, failed requests are logged to the errors file.
+        If no request succeeded and `embedding_dim` is not given, "embeddings" is None and no .npy file is written.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    texts = [job if isinstance(job, str) else job["input"] for job in request_batch]
+    metadata = {
+        request_id: job["metadata"]
+        for request_id, job in enumerate(request_batch)
+        if isinstance(job, dict) and job.get("metadata") is not None
+    }
+
+    _, default_tokens_per_minute, default_token_counter = get_limits(model_name)
+    if token_counter is None:
+        token_counter = default_token_counter
+    if max_tokens_per_minute is None:
+        max_tokens_per_minute = default_tokens_per_minute
+    if max_tokens_per_request > max_tokens_per_minute:
+        # a larger request never fits into the token capacity, so it would wait forever
+        logging.warning(
+            f"Lowering max_tokens_per_request from {max_tokens_per_request} to the token limit {max_tokens_per_minute}"
+        )
+        max_tokens_per_request = max_tokens_per_minute
+    if isinstance(token_counter, str):
+        token_counter = get_token_counter(token_counter)
+
+    file_prefix = os.path.join(cache_dir, f"batch_embed_{time.time()}")
+    embedding_writer = EmbeddingWriter(
+        save_filepath=f"{file_prefix}.npy", num_embeddings=len(texts), embedding_dim=embedding_dim
+    )
+    asyncio.run(
+        process_api_batch_request(
+            request_batch=pack_embedding_requests(
+                texts,
+                model_name=model_name,
+                token_counter=token_counter,
+                max_inputs_per_request=max_inputs_per_request,
+                max_tokens_per_request=max_tokens_per_request,
+                encoding_format=encoding_format,
+            ),
+            save_filepath=f"{file_prefix}_errors.jsonl",
+            request_url=request_url,
+            model_name=model_name,
+            max_attempts=max_attempts,
+            max_requests_per_minute=max_requests_per_minute,
+            max_tokens_per_minute=max_tokens_per_minute,
+            token_counter=token_counter,
+            response_handler=embedding_writer,
+        )
+    )
+    embedding_writer.flush()
+
+    request_ids = np.flatnonzero(embedding_writer.is_embedded)
+    np.save(f"{file_prefix}_ids.npy", request_ids)
+    if embedding_writer.embeddings is None:
+        logging.error(f"No text was embedded, see {file_prefix}_errors.jsonl")
+    else:
+        logging.info(f"Embedded {len(request_ids)} / {len(texts)} texts, saved to {file_prefix}.npy")
+
+    return {
+        "embeddings": embedding_writer.embeddings,
+        "request_ids": request_ids,
+        "metadata": metadata,
+    }
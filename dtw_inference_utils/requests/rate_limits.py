@@ -1,17 +1,21 @@
-import tiktoken
+from typing import Union
+
+from dtw_inference_utils.requests.token_counters import TokenCounter, get_token_counter
 
 
 def num_tokens_consumed_from_request(
         request_json: dict,
         api_endpoint: str,
-        token_encoding_name: str,
+        token_encoding_name: Union[str, TokenCounter],
 ):
-    """Count the number of tokens in the request. Only supports completion and embedding requests."""
-
-    if "zephyr" in token_encoding_name:
-        return 100
+    """Count the number of tokens in the request. Only supports completion and embedding requests.
 
-    encoding = tiktoken.get_encoding(token_encoding_name)
+    `token_encoding_name` is a tiktoken encoding name, the path of a HuggingFace tokenizer or a TokenCounter.
+    """
+    if isinstance(token_encoding_name, TokenCounter):
+        token_counter = token_encoding_name
+    else:
+        token_counter = get_token_counter(token_encoding_name)
     # if completions request, tokens = prompt + n * max_tokens
     if api_endpoint.endswith("completions"):
         max_tokens = request_json.get("max_tokens", 15)
@@ -20,24 +24,17 @@ def num_tokens_consumed_from_request(
 
         # chat completions
         if api_endpoint.startswith("chat/"):
-            num_tokens = 0
-            for message in request_json["messages"]:
-                num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-                for key, value in message.items():
-                    num_tokens += len(encoding.encode(value))
-                    if key == "name":  # if there's a name, the role is omitted
-                        num_tokens -= 1  # role is always required and always 1 token
-            num_tokens += 2  # every reply is primed with <im_start>assistant
+            num_tokens = token_counter.num_tokens_from_messages(request_json["messages"])
             return num_tokens + completion_tokens
         # normal completions
         else:
             prompt = request_json["prompt"]
             if isinstance(prompt, str):  # single prompt
-                prompt_tokens = len(encoding.encode(prompt))
+                prompt_tokens = token_counter.num_tokens(prompt)
                 num_tokens = prompt_tokens + completion_tokens
                 return num_tokens
             elif isinstance(prompt, list):  # multiple prompts
-                prompt_tokens = sum([len(encoding.encode(p)) for p in prompt])
+                prompt_tokens = sum([token_counter.num_tokens(p) for p in prompt])
                 num_tokens = prompt_tokens + completion_tokens * len(prompt)
                 return num_tokens
             else:
@@ -48,10 +45,10 @@ def num_tokens_consumed_from_request(
     elif api_endpoint == "embeddings":
         input = request_json["input"]
         if isinstance(input, str):  # single input
-            num_tokens = len(encoding.encode(input))
+            num_tokens = token_counter.num_tokens(input)
             return num_tokens
         elif isinstance(input, list):  # multiple inputs
-            num_tokens = sum([len(encoding.encode(i)) for i in input])
+            num_tokens = sum([token_counter.num_tokens(i) for i in input])
             return num_tokens
         else:
             raise TypeError(
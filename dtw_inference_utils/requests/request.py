@@ -6,8 +6,12 @@ import aiohttp
 
 import json
 from dataclasses import dataclass, field
+from typing import Callable
 
-from dtw_inference_utils.requests.status import StatusTracker
+from dtw_inference_utils.requests.status import ConcurrencyLimitStatus, StatusTracker
+
+# status codes of rate limits and of overloaded or unreachable servers and gateways
+OVERLOAD_STATUS_CODES = {429, 502, 503, 504}
 
 
 @dataclass
@@ -29,18 +33,30 @@ class APIRequest:
             retry_queue: asyncio.Queue,
             save_filepath: str,
             status_tracker: StatusTracker,
+            concurrency_limit_status: ConcurrencyLimitStatus = None,
+            response_handler: Callable[[dict, dict, dict], None] = None,
     ):
-        """Calls the OpenAI API and saves results."""
+        """Calls the OpenAI API and saves results.
+
+        Successful responses are appended to `save_filepath`, unless a `response_handler` is given, which is
+        called with the request, the response and the metadata instead.
+        """
         logging.info(f"Starting request #{self.task_id}")
         error = None
+        overloaded = False  # whether the error says that the backend is overloaded
+        start_time = time.time()
         try:
             async with session.post(url=request_url, headers=request_header, json=self.request_json) as response:
+                status = response.status
+                overloaded = status in OVERLOAD_STATUS_CODES
                 response = await response.json()
-            if "error" in response:
-                logging.warning(f"Request {self.task_id} failed with error {response['error']}")
+            # vllm reports errors as {"object": "error", "message": ...}, so rely on the status code as well
+            if "error" in response or status >= 400:
+                logging.warning(f"Request {self.task_id} failed with error {response.get('error', response)}")
                 status_tracker.num_api_errors += 1
                 error = response
-                if "Rate limit" in response["error"].get("message", ""):
+                if "Rate limit" in str(response.get("error", {}).get("message", "")):
+                    overloaded = True
                     status_tracker.time_of_last_rate_limit_error = time.time()
                     status_tracker.num_rate_limit_errors += 1
                     status_tracker.num_api_errors -= 1  # rate limit errors are counted separately
@@ -49,6 +65,20 @@ class APIRequest:
             logging.warning(f"Request {self.task_id} failed with Exception {e}")
             status_tracker.num_other_errors += 1
             error = e
+            overloaded = overloaded or isinstance(e, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+        if error is None and response_handler is not None:
+            try:
+                response_handler(self.request_json, response, self.metadata)
+            except Exception as e:  # e.g. an unexpected response format, retry or save it like any other error
+                logging.warning(f"Request {self.task_id} failed in response handler with Exception {e}")
+                status_tracker.num_other_errors += 1
+                error = e
+        if concurrency_limit_status is not None:
+            concurrency_limit_status.on_request_finished(
+                latency=latency_per_token(time.time() - start_time, None if error else response),
+                error=error is not None,
+                overloaded=error is not None and overloaded,
+            )
         if error:
             self.result.append(error)
             if self.attempts_left:
@@ -63,16 +93,27 @@ class APIRequest:
                 status_tracker.num_tasks_in_progress -= 1
                 status_tracker.num_tasks_failed += 1
         else:
-            data = (
-                [self.request_json, response, self.metadata]
-                if self.metadata else [self.request_json, response]
-            )
-            append_to_jsonl(data, save_filepath)
+            if response_handler is None:
+                data = (
+                    [self.request_json, response, self.metadata]
+                    if self.metadata else [self.request_json, response]
+                )
+                append_to_jsonl(data, save_filepath)
             status_tracker.num_tasks_in_progress -= 1
             status_tracker.num_tasks_succeeded += 1
             logging.debug(f"Request {self.task_id} saved to {save_filepath}")
 
 
+def latency_per_token(latency: float, response: dict = None) -> float:
+    """Normalize latency by the tokens processed, so that it does not depend on prompt and output lengths."""
+    if not isinstance(response, dict):
+        return latency
+    num_tokens = (response.get("usage") or {}).get("total_tokens")
+    if not num_tokens:
+        return latency
+    return latency / num_tokens
+
+
 def append_to_jsonl(data, filename: str) -> None:
     """Append a json payload to the end of a jsonl file."""
     json_string = json.dumps(data)
@@ -47,4 +47,100 @@ class RateLimitStatus:
 
     def update_capacity(self, num_tokens: int):
         self.available_request_capacity -= 1
-        self.available_token_capacity -= num_tokens
\ No newline at end of file
+        self.available_token_capacity -= num_tokens
+
+
+class ConcurrencyLimitStatus:
+    """Limits the number of requests in flight instead of requests and tokens per minute.
+
+    The limit adapts to the observed latency, following the gradient approach of Netflix' concurrency-limits:
+    As long as the current latency stays close to the latency of the unloaded backend, the limit grows, once
+    requests start to queue up in the backend and latency increases, it shrinks. Overload errors shrink it
+    multiplicatively. This finds and holds the saturation point of backends without published rate limits,
+    e.g. local vllm servers.
+
+    The unloaded latency is the lowest latency seen since the last probe. Every `probe_interval` round trips, the
+    limit is lowered by `probe_ratio` for `probe_round_trips` round trips to measure it again, so that it follows
+    changes of the workload, e.g. longer prompts.
+    """
+
+    def __init__(
+            self,
+            initial_limit: int = 16,
+            min_limit: int = 1,
+            max_limit: int = 1024,
+            tolerance: float = 1.25,
+            short_window: int = 10,
+            probe_interval: float = 100,
+            probe_ratio: float = 0.5,
+            probe_round_trips: float = 2,
+            backoff_ratio: float = 0.9,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance  # latency may grow by this factor before the limit shrinks
+        self.backoff_ratio = backoff_ratio
+
+        self.num_requests_in_flight = 0
+        self.short_latency = None  # moving average of the current latency
+        self.short_alpha = 2 / (short_window + 1)
+        self.baseline_latency = None  # lowest moving average since the last probe
+
+        self.probe_interval = probe_interval
+        self.probe_ratio = probe_ratio
+        self.probe_round_trips = probe_round_trips
+        self.round_trips_since_probe = 0.0
+        self.probe_round_trips_left = 0.0
+
+    def reset_capacity(self):
+        pass  # capacity is freed when requests finish, not over time
+
+    def is_capacity_available(self, num_tokens: int):
+        return self.num_requests_in_flight < int(self.limit)
+
+    def update_capacity(self, num_tokens: int):
+        self.num_requests_in_flight += 1
+
+    def on_request_finished(self, latency: float, error: bool = False, overloaded: bool = False):
+        """Free the request's slot and adapt the limit to its latency.
+
+        Errors that signal an overloaded backend, e.g. 429, 503 or timeouts, shrink the limit, other errors,
+        e.g. a too long prompt, leave it unchanged.
+        """
+        num_requests_in_flight = self.num_requests_in_flight  # including this request
+        self.num_requests_in_flight -= 1
+
+        if overloaded:
+            self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+            return
+        if error:
+            return
+
+        if self.short_latency is None:
+            self.short_latency = latency
+        self.short_latency += self.short_alpha * (latency - self.short_latency)
+        if self.baseline_latency is None or self.short_latency < self.baseline_latency:
+            self.baseline_latency = self.short_latency
+
+        # a request finishing is 1 / limit of a round trip
+        if self.probe_round_trips_left > 0:
+            self.probe_round_trips_left -= 1 / self.limit
+            return  # hold the lowered limit while the baseline is measured
+        self.round_trips_since_probe += 1 / self.limit
+        if self.round_trips_since_probe >= self.probe_interval:
+            self.round_trips_since_probe = 0.0
+            self.probe_round_trips_left = self.probe_round_trips
+            self.limit = max(self.min_limit, self.limit * self.probe_ratio)
+            self.baseline_latency = None
+            return
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.baseline_latency / self.short_latency))
+        queue_size = self.limit ** 0.5  # headroom that lets the limit grow while latency is stable
+        new_limit = self.limit * gradient + queue_size
+        if new_limit > self.limit and num_requests_in_flight < self.limit / 2:
+            return  # the limit is not the bottleneck, so latency tells nothing about a higher one
+        # every request moves the limit a fraction of the way, so that one round trip of `limit` requests makes one
+        # full step, independent of how many requests are in flight
+        new_limit = self.limit + (new_limit - self.limit) / self.limit
+        self.limit = max(self.min_limit, min(self.max_limit, new_limit))
@@ -0,0 +1,96 @@
+import logging
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import List
+
+import tiktoken
+
+
+class TokenCounter(ABC):
+    """Counts the prompt tokens of a request, used to stay under token rate limits."""
+
+    @abstractmethod
+    def num_tokens(self, text: str) -> int:
+        pass
+
+    @abstractmethod
+    def num_tokens_from_messages(self, messages: List[dict]) -> int:
+        pass
+
+
+class TiktokenCounter(TokenCounter):
+    """Counts tokens for OpenAI models using tiktoken."""
+
+    def __init__(self, encoding_name: str):
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def num_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    def num_tokens_from_messages(self, messages: List[dict]) -> int:
+        num_tokens = 0
+        for message in messages:
+            num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+            for key, value in message.items():
+                num_tokens += len(self.encoding.encode(value))
+                if key == "name":  # if there's a name, the role is omitted
+                    num_tokens -= 1  # role is always required and always 1 token
+        num_tokens += 2  # every reply is primed with <im_start>assistant
+        return num_tokens
+
+
+class HuggingFaceTokenCounter(TokenCounter):
+    """Counts tokens exactly like a vllm server does, using the model's HuggingFace tokenizer and chat template.
+
+    Args:
+        tokenizer_path: Local path or HuggingFace hub ID of the tokenizer, usually the path passed to vllm.
+    """
+
+    def __init__(self, tokenizer_path: str):
+        try:
+            from transformers import AutoTokenizer
+        except ImportError:
+            raise ImportError(
+                "Counting tokens for non-OpenAI models needs transformers, "
+                'install it with `pip install "dtw_inference_utils[tokenizers]"`.'
+            )
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+
+    def num_tokens(self, text: str) -> int:
+        # vllm adds special tokens, e.g. BOS, to completion prompts as well
+        return len(self.tokenizer.encode(text))
+
+    def num_tokens_from_messages(self, messages: List[dict]) -> int:
+        if self.tokenizer.chat_template is None:
+            # without a chat template, vllm cannot format the messages either, so only approximate
+            return self._approximate_num_tokens_from_messages(messages)
+        from jinja2 import TemplateError  # installed with transformers' chat template support
+
+        # render first and tokenize without special tokens, as the template already contains them
+        try:
+            prompt = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        except TemplateError as e:
+            # e.g. "System role not supported", vllm rejects the request, which then fails on its own
+            logging.warning(f"Cannot apply chat template, approximating token count: {e}")
+            return self._approximate_num_tokens_from_messages(messages)
+        return len(self.tokenizer.encode(prompt, add_special_tokens=False))
+
+    def _approximate_num_tokens_from_messages(self, messages: List[dict]) -> int:
+        return sum(self.num_tokens(message["content"]) + 4 for message in messages) + 2
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(token_encoding_name: str) -> TokenCounter:
+    """Return a cached token counter for a tiktoken encoding name or a HuggingFace tokenizer path.
+
+    If the HuggingFace tokenizer cannot be loaded, token counts are approximated with tiktoken's cl100k_base.
+    """
+    if token_encoding_name in tiktoken.list_encoding_names():
+        return TiktokenCounter(token_encoding_name)
+    try:
+        return HuggingFaceTokenCounter(token_encoding_name)
+    except (ImportError, OSError, ValueError) as e:
+        logging.warning(
+            f"Cannot load tokenizer {token_encoding_name}, approximating token counts with cl100k_base: {e}"
+        )
+        return TiktokenCounter("cl100k_base")
@@ -0,0 +1,379 @@
+"""Gateway that fronts several OpenAI compatible backends (e.g. vllm replicas).
+
+The gateway balances requests over the healthy backends, merges identical
+in-flight requests into a single upstream call and optionally caches responses.
+Backends only have to expose a ``/health`` endpoint, so stub servers can be used
+in place of vllm.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import subprocess
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional
+
+import aiohttp
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+
+# headers that must not be forwarded between client, gateway and backend
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "content-encoding",
+    "content-length",
+    "host",
+    "keep-alive",
+    "transfer-encoding",
+}
+
+
+@dataclass
+class Backend:
+    """Stores the state of one backend replica."""
+
+    url: str
+    healthy: bool = False
+    num_requests_in_flight: int = 0
+    num_failures: int = 0  # consecutive failed health checks
+
+
+@dataclass
+class CachedResponse:
+    """Response of a backend that can be replayed to several clients."""
+
+    status_code: int
+    body: bytes
+    media_type: Optional[str] = None
+
+
+@dataclass
+class StreamedResponse:
+    """Response of a backend that is passed on chunk by chunk."""
+
+    status_code: int
+    chunks: AsyncIterator[bytes]
+    media_type: Optional[str] = None
+
+
+class ResponseCache:
+    """LRU cache of successful responses, keyed by request path and body."""
+
+    def __init__(self, max_size: int = 0):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key: str, response: CachedResponse):
+        if self.max_size <= 0 or response.status_code != 200:
+            return
+        self._entries[key] = response
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Gateway:
+    """Load balances, coalesces and caches requests over a set of backends."""
+
+    def __init__(
+            self,
+            backend_urls: List[str],
+            cache_size: int = 0,
+            health_check_interval: float = 5.0,
+            max_health_check_failures: int = 2,
+            request_timeout: float = 600.0,
+    ):
+        self.backends = [Backend(url=url.rstrip("/")) for url in backend_urls]
+        self.cache = ResponseCache(max_size=cache_size)
+        self.health_check_interval = health_check_interval
+        self.max_health_check_failures = max_health_check_failures
+        self.request_timeout = request_timeout
+
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._health_check_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.request_timeout))
+        await self.check_health()
+        self._health_check_task = asyncio.create_task(self._health_check_loop())
+
+    async def stop(self):
+        if self._health_check_task is not None:
+            self._health_check_task.cancel()
+        if self.session is not None:
+            await self.session.close()
+
+    async def _check_backend(self, backend: Backend):
+        try:
+            async with self.session.get(
+                    f"{backend.url}/health", timeout=aiohttp.ClientTimeout(total=self.health_check_interval)
+            ) as response:
+                healthy = response.status == 200
+        except Exception:
+            healthy = False
+
+        if healthy:
+            if not backend.healthy:
+                logging.info(f"Backend {backend.url} is healthy")
+            backend.healthy = True
+            backend.num_failures = 0
+        else:
+            backend.num_failures += 1
+            if backend.healthy and backend.num_failures >= self.max_health_check_failures:
+                logging.warning(f"Backend {backend.url} failed {backend.num_failures} health checks")
+                backend.healthy = False
+
+    async def check_health(self):
+        await asyncio.gather(*[self._check_backend(backend) for backend in self.backends])
+
+    async def _health_check_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            await self.check_health()
+
+    def pick_backend(self) -> Optional[Backend]:
+        """Return the healthy backend with the fewest requests in flight."""
+        healthy_backends = [backend for backend in self.backends if backend.healthy]
+        if not healthy_backends:
+            return None
+        return min(healthy_backends, key=lambda backend: backend.num_requests_in_flight)
+
+    async def _forward(self, method: str, path: str, body: bytes, headers: dict) -> CachedResponse:
+        # a failing backend is taken out of rotation, so the retry goes to another healthy one
+        for attempt in range(2):
+            backend = self.pick_backend()
+            if backend is None:
+                return error_response(503, "No healthy backend available")
+
+            backend.num_requests_in_flight += 1
+            try:
+                async with self.session.request(
+                        method, f"{backend.url}/{path}", data=body, headers=headers
+                ) as response:
+                    return CachedResponse(
+                        status_code=response.status,
+                        body=await response.read(),
+                        media_type=response.content_type,
+                    )
+            except asyncio.TimeoutError:
+                logging.warning(f"Request to backend {backend.url} timed out")
+                return error_response(504, "Backend timed out")
+            except aiohttp.ClientError as e:
+                # the backend died between two health checks, take it out of rotation right away
+                logging.warning(f"Backend {backend.url} failed: {e}")
+                backend.healthy = False
+            finally:
+                backend.num_requests_in_flight -= 1
+
+        return error_response(502, "Backend unreachable")
+
+    async def handle(self, method: str, path: str, body: bytes, headers: dict) -> CachedResponse:
+        """Serve a request from the cache, an identical in-flight request or a backend."""
+        if method != "POST":
+            return await self._forward(method, path, body, headers)
+
+        # clients with different API keys must not share responses
+        authorization = next((value for key, value in headers.items() if key.lower() == "authorization"), "")
+        key = hashlib.sha256(path.encode() + b"\0" + authorization.encode() + b"\0" + body).hexdigest()
+        cached_response = self.cache.get(key)
+        if cached_response is not None:
+            return cached_response
+
+        if key in self._in_flight:
+            future = self._in_flight[key]
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # this request itself was cancelled
+                # the client of the first request went away, send the request again
+                return await self.handle(method, path, body, headers)
+            except Exception as e:
+                logging.warning(f"Coalesced request failed: {e}")
+                return error_response(502, "Gateway error")
+
+        future = asyncio.get_running_loop().create_future()
+        # mark the exception as retrieved, it is re-raised to the first caller anyway
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._in_flight[key] = future
+        try:
+            response = await self._forward(method, path, body, headers)
+            self.cache.put(key, response)
+            future.set_result(response)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._in_flight[key]
+        return response
+
+    async def stream(self, method: str, path: str, body: bytes, headers: dict):
+        """Proxy a streaming request chunk by chunk, without coalescing or caching.
+
+        Returns a StreamedResponse, or a CachedResponse if the backend is unavailable or answers with an error.
+        """
+        backend = self.pick_backend()
+        if backend is None:
+            return error_response(503, "No healthy backend available")
+
+        backend.num_requests_in_flight += 1
+        try:
+            response = await self.session.request(method, f"{backend.url}/{path}", data=body, headers=headers)
+        except asyncio.TimeoutError:
+            backend.num_requests_in_flight -= 1
+            logging.warning(f"Request to backend {backend.url} timed out")
+            return error_response(504, "Backend timed out")
+        except aiohttp.ClientError as e:
+            backend.num_requests_in_flight -= 1
+            logging.warning(f"Backend {backend.url} failed: {e}")
+            backend.healthy = False
+            return error_response(502, "Backend unreachable")
+
+        if response.status != 200:
+            try:
+                return CachedResponse(
+                    status_code=response.status, body=await response.read(), media_type=response.content_type
+                )
+            finally:
+                response.release()
+                backend.num_requests_in_flight -= 1
+
+        async def chunks():
+            try:
+                async for chunk in response.content.iter_any():
+                    yield chunk
+            finally:
+                response.release()
+                backend.num_requests_in_flight -= 1
+
+        return StreamedResponse(status_code=response.status, chunks=chunks(), media_type=response.content_type)
+
+
+def error_response(status_code: int, message: str) -> CachedResponse:
+    """Build an error in the format of the OpenAI API."""
+    body = {"error": {"message": message, "type": "gateway_error", "param": None, "code": status_code}}
+    return CachedResponse(status_code=status_code, body=json.dumps(body).encode(), media_type="application/json")
+
+
+def _is_streaming_request(body: bytes) -> bool:
+    if b'"stream"' not in body:
+        return False
+    try:
+        return bool(json.loads(body).get("stream", False))
+    except (ValueError, AttributeError):
+        return False
+
+
+def create_app(
+        backend_urls: List[str],
+        cache_size: int = 0,
+        health_check_interval: float = 5.0,
+        request_timeout: float = 600.0,
+) -> FastAPI:
+    """Create the gateway app forwarding every route to one of `backend_urls`."""
+    gateway = Gateway(
+        backend_urls=backend_urls,
+        cache_size=cache_size,
+        health_check_interval=health_check_interval,
+        request_timeout=request_timeout,
+    )
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        await gateway.start()
+        yield
+        await gateway.stop()
+
+    app = FastAPI(lifespan=lifespan)
+    app.state.gateway = gateway
+
+    @app.get("/health")
+    async def health():
+        if gateway.pick_backend() is None:
+            return JSONResponse({"healthy_backends": 0}, status_code=503)
+        return {"healthy_backends": sum(backend.healthy for backend in gateway.backends)}
+
+    @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
+    async def proxy(path: str, request: Request):
+        body = await request.body()
+        headers = {
+            key: value for key, value in request.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS
+        }
+        if request.url.query:
+            path = f"{path}?{request.url.query}"
+
+        if request.method == "POST" and _is_streaming_request(body):
+            response = await gateway.stream(request.method, path, body, headers)
+            if isinstance(response, StreamedResponse):
+                return StreamingResponse(
+                    response.chunks, status_code=response.status_code, media_type=response.media_type
+                )
+        else:
+            response = await gateway.handle(request.method, path, body, headers)
+        return Response(content=response.body, status_code=response.status_code, media_type=response.media_type)
+
+    return app
+
+
+async def wait_until_ready(
+        backend_urls: List[str],
+        timeout: float = 600.0,
+        poll_interval: float = 2.0,
+        processes: List[subprocess.Popen] = None,
+) -> bool:
+    """Wait until all backends answer their health check.
+
+    Returns False on timeout, or as soon as one of the backend `processes` exited, e.g. because the model
+    could not be loaded.
+    """
+    pending = [url.rstrip("/") for url in backend_urls]
+    start_time = time.time()
+
+    async with aiohttp.ClientSession() as session:
+        while pending and time.time() - start_time < timeout:
+            for process in processes or []:
+                if process.poll() is not None:
+                    logging.error(f"Backend process {process.pid} exited with code {process.returncode}")
+                    return False
+
+            still_pending = []
+            for url in pending:
+                try:
+                    async with session.get(
+                            f"{url}/health", timeout=aiohttp.ClientTimeout(total=poll_interval)
+                    ) as response:
+                        if response.status != 200:
+                            still_pending.append(url)
+                except Exception:
+                    still_pending.append(url)
+            if len(still_pending) < len(pending):
+                logging.info(f"{len(backend_urls) - len(still_pending)} / {len(backend_urls)} backends ready")
+            pending = still_pending
+            if pending:
+                await asyncio.sleep(poll_interval)
+
+    if pending:
+        logging.error(f"{len(pending)} backends not ready after {timeout} seconds")
+    return not pending
+
+
+def backend_urls_from_ports(ports: List[int], host: str = "localhost") -> List[str]:
+    return [f"http://{host}:{port}" for port in ports]
@@ -1,5 +1,7 @@
+import asyncio
 import logging
-from re import T
+import os
+import shlex
 import subprocess
 
 import click
@@ -7,6 +9,58 @@ import click
 from dtw_inference_utils.log import init_logging
 
 
+def build_backend_command(model, server_type, port, disable_log_requests, backend_cmd=None):
+    """Return the command starting one backend server on `port`."""
+    if backend_cmd is not None:
+        # custom backends, e.g. stub servers for testing, get the port and model via placeholders
+        return shlex.split(backend_cmd.format(port=port, model=model))
+
+    server_cmd = (
+        "vllm.entrypoints.openai.api_server"
+        if server_type == "OpenAI"
+        else "vllm.entrypoints.api_server"
+    )
+
+    cmd_list = ["python", "-m", server_cmd, "--model", model, "--port", str(port)]
+    if disable_log_requests:
+        cmd_list.append("--disable-log-requests")
+    return cmd_list
+
+
+def launch_backends(model, server_type, num_replicas, backend_port, gpus_per_replica, disable_log_requests,
+                    backend_cmd=None):
+    """Start `num_replicas` backend processes on consecutive ports, each pinned to its own GPUs."""
+    processes = []
+    for replica_idx in range(num_replicas):
+        port = backend_port + replica_idx
+        cmd_list = build_backend_command(model, server_type, port, disable_log_requests, backend_cmd)
+
+        env = os.environ.copy()
+        if gpus_per_replica > 0:
+            gpu_ids = range(replica_idx * gpus_per_replica, (replica_idx + 1) * gpus_per_replica)
+            env["CUDA_VISIBLE_DEVICES"] = ",".join(str(gpu_id) for gpu_id in gpu_ids)
+
+        logging.info(f"Running command for replica {replica_idx}: {' '.join(cmd_list)}")
+        try:
+            processes.append(subprocess.Popen(cmd_list, env=env))
+        except BaseException:
+            # do not leave the replicas that already started behind
+            stop_backends(processes)
+            raise
+    return processes
+
+
+def stop_backends(processes, timeout=30):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
 @click.command()
 @click.option(
     "--model", type=str, help="Model ID", default="HuggingFaceH4/zephyr-7b-beta"
@@ -18,35 +72,67 @@ from dtw_inference_utils.log import init_logging
     default="OpenAI",
 )
 @click.option(
-    "--disable-log-requests",
-    is_flag=True,
+    "--disable-log-requests/--enable-log-requests",
     help="Disable logging of requests",
     default=True,
 )
-def start_server(model, server_type):
+@click.option(
+    "--num_replicas",
+    type=int,
+    help="Number of backend servers. With more than one, a gateway is started in front of them.",
+    default=1,
+)
+@click.option("--host", type=str, help="Host of the gateway.", default="0.0.0.0")
+@click.option("--port", type=int, help="Port of the gateway, or of the server if only one replica is used.",
+              default=8000)
+@click.option("--backend_port", type=int, help="Port of the first backend, the others follow.", default=8100)
+@click.option(
+    "--gpus_per_replica",
+    type=int,
+    help="Number of GPUs each replica sees via CUDA_VISIBLE_DEVICES. Use 0 to leave it untouched.",
+    default=1,
+)
+@click.option("--cache_size", type=int, help="Number of responses cached by the gateway, 0 disables it.",
+              default=0)
+@click.option("--health_check_interval", type=float, help="Seconds between backend health checks.", default=5.0)
+@click.option("--ready_timeout", type=float, help="Seconds to wait for the backends to come up.", default=1800.0)
+@click.option(
+    "--backend_cmd",
+    type=str,
+    help='Custom backend command instead of vllm, "{port}" and "{model}" are filled in.',
+    default=None,
+)
+def start_server(model, server_type, disable_log_requests, num_replicas, host, port, backend_port,
+                 gpus_per_replica, cache_size, health_check_interval, ready_timeout, backend_cmd):
     init_logging()
 
-    if server_type not in ["OpenAI", "standard"]:
-        print("Invalid server type. Allowed values are 'OpenAI' and 'standard'.")
-        exit(1)
-
     logging.info(f"Starting server for model {model} with server type {server_type}")
 
-    log_flag = "--disable-log-requests" if server_type == "OpenAI" else "[]"
+    if num_replicas <= 1:
+        cmd_list = build_backend_command(model, server_type, port, disable_log_requests, backend_cmd)
+        logging.info(f"Running command: {' '.join(cmd_list)}")
+        subprocess.run(cmd_list, check=True)
+        return
 
-    server_cmd = (
-        "vllm.entrypoints.openai.api_server"
-        if server_type == "OpenAI"
-        else "vllm.entrypoints.api_server"
-    )
+    # import here, so that the single server mode does not need the gateway dependencies
+    import uvicorn
 
-    cmd_list = ["python", "-m", server_cmd, "--model", model, log_flag]
-    logging.info(f"Running command: {' '.join(cmd_list)}")
+    from dtw_inference_utils.scripts.gateway import backend_urls_from_ports, create_app, wait_until_ready
 
-    subprocess.run(
-        ["python", "-m", server_cmd, "--model", model, log_flag],
-        check=True,
+    backend_urls = backend_urls_from_ports(range(backend_port, backend_port + num_replicas))
+    processes = launch_backends(
+        model, server_type, num_replicas, backend_port, gpus_per_replica, disable_log_requests, backend_cmd
     )
+    try:
+        if not asyncio.run(wait_until_ready(backend_urls, timeout=ready_timeout, processes=processes)):
+            logging.error("Backends not ready, shutting down.")
+            exit(1)
+
+        logging.info(f"Starting gateway on {host}:{port} for {num_replicas} backends")
+        app = create_app(backend_urls, cache_size=cache_size, health_check_interval=health_check_interval)
+        uvicorn.run(app, host=host, port=port)
+    finally:
+        stop_backends(processes)
 
 
 if __name__ == "__main__":
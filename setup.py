@@ -11,7 +11,7 @@ with open("dtw_inference_utils/version.py", "r") as version_file:
 with open("requirements.txt") as f:
     requirements = f.readlines()
 
-test_requirements = ["pytest"]
+test_requirements = ["pytest", "httpx"]
 
 # Use README.md as the long_description for the package
 with open("README.md", "r") as readme_file:
@@ -36,6 +36,7 @@ setup(
     extras_require={
         "test": test_requirements,
         "server": ["fschat[model_worker,webui]", "vllm"],
+        "tokenizers": ["transformers", "jinja2"],
     },
     entry_points="""
         [console_scripts]
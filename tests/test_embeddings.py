@@ -0,0 +1,153 @@
+import asyncio
+import base64
+import threading
+
+import numpy as np
+import pytest
+from aiohttp import web
+
+from dtw_inference_utils.requests import rate_limits
+from dtw_inference_utils.requests.embeddings import batch_embed, pack_embedding_requests
+from dtw_inference_utils.requests.token_counters import TokenCounter
+
+
+class WordCounter(TokenCounter):
+    def num_tokens(self, text):
+        return len(text.split())
+
+    def num_tokens_from_messages(self, messages):
+        return sum(self.num_tokens(message["content"]) for message in messages)
+
+
+class StubEmbeddingServer:
+    """Embeds each text as [len(text)] * 4, or answers every request with `error`, in a background thread."""
+
+    def __init__(self, error: dict = None, status: int = 200, indices=None):
+        self.error = error
+        self.status = status
+        self.indices = indices  # function of the number of inputs, the indices to answer with
+        self.num_calls = 0
+        self.loop = asyncio.new_event_loop()
+        self.url = None
+
+    async def embeddings(self, request):
+        self.num_calls += 1
+        body = await request.json()
+        if self.error is not None:
+            return web.json_response(self.error, status=self.status)
+        data = []
+        indices = range(len(body["input"])) if self.indices is None else self.indices(len(body["input"]))
+        for index in indices:
+            text = body["input"][index]
+            embedding = np.full(4, len(text), dtype=np.float32)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(embedding.tobytes()).decode()
+            else:
+                embedding = embedding.tolist()
+            data.append({"index": index, "embedding": embedding})
+        return web.json_response({"data": data, "usage": {"total_tokens": len(body["input"])}})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/v1/embeddings", self.embeddings)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "localhost", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://localhost:{port}/v1/embeddings"
+
+    def __enter__(self):
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+        return self
+
+    def __exit__(self, *args):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def embed(server, texts, tmp_path, **kwargs):
+    kwargs = {"max_requests_per_minute": 100000, "max_tokens_per_minute": 10 ** 9, **kwargs}
+    return batch_embed(
+        texts,
+        cache_dir=str(tmp_path),
+        model_name="stub",
+        request_url=server.url,
+        token_counter=WordCounter(),
+        **kwargs,
+    )
+
+
+def test_pack_embedding_requests_respects_caps():
+    texts = ["a b c"] * 10
+    requests = list(pack_embedding_requests(
+        texts, model_name="stub", token_counter=WordCounter(), max_inputs_per_request=4, max_tokens_per_request=9
+    ))
+    assert [len(request["input"]) for request in requests] == [3, 3, 3, 1]
+    assert [request["token_consumption"] for request in requests] == [9, 9, 9, 3]
+    assert sum([request["metadata"]["request_ids"] for request in requests], []) == list(range(10))
+
+
+def test_pack_embedding_requests_sends_too_long_texts_alone():
+    requests = list(pack_embedding_requests(
+        ["a", "a b c d e", "a"], model_name="stub", token_counter=WordCounter(), max_tokens_per_request=3
+    ))
+    assert [request["input"] for request in requests] == [["a"], ["a b c d e"], ["a"]]
+    assert [request["token_consumption"] for request in requests] == [1, 3, 1]
+
+
+@pytest.mark.parametrize("encoding_format", ["float", "base64"])
+def test_batch_embed_writes_rows_by_request_id(tmp_path, encoding_format, monkeypatch):
+    def fail(*args):
+        raise AssertionError("packed requests must not be tokenized again")
+
+    monkeypatch.setattr(rate_limits, "get_token_counter", fail)
+    texts = ["word " * (idx % 7 + 1) for idx in range(100)]
+    jobs = texts[:50] + [{"input": text, "metadata": {"idx": idx}} for idx, text in enumerate(texts[50:])]
+
+    with StubEmbeddingServer() as server:
+        result = embed(server, jobs, tmp_path, max_inputs_per_request=8, encoding_format=encoding_format)
+
+    assert server.num_calls == 13
+    assert result["embeddings"].shape == (100, 4)
+    np.testing.assert_array_equal(result["embeddings"][:, 0], [len(text) for text in texts])
+    np.testing.assert_array_equal(result["request_ids"], np.arange(100))
+    assert len(result["metadata"]) == 50
+
+
+@pytest.mark.parametrize("status,error", [
+    (400, {"object": "error", "message": "input too long"}),  # vllm
+    (200, {"object": "list"}),  # no "data"
+])
+def test_batch_embed_finishes_when_all_requests_fail(tmp_path, status, error):
+    with StubEmbeddingServer(error=error, status=status) as server:
+        result = embed(server, ["a", "b"], tmp_path, max_attempts=2, embedding_dim=4)
+
+    assert server.num_calls == 2
+    assert len(result["request_ids"]) == 0
+    np.testing.assert_array_equal(result["embeddings"], np.zeros((2, 4)))
+    assert len(list(tmp_path.glob("*_errors.jsonl"))) == 1
+
+
+@pytest.mark.parametrize("indices", [
+    lambda num_inputs: range(num_inputs - 1),  # missing
+    lambda num_inputs: [0] * num_inputs,  # duplicate
+])
+def test_batch_embed_fails_requests_with_wrong_indices(tmp_path, indices):
+    with StubEmbeddingServer(indices=indices) as server:
+        result = embed(server, ["a", "b"], tmp_path, max_attempts=2, embedding_dim=4)
+
+    assert server.num_calls == 2
+    assert len(result["request_ids"]) == 0
+    np.testing.assert_array_equal(result["embeddings"], np.zeros((2, 4)))
+
+
+def test_batch_embed_packs_requests_under_token_limit(tmp_path):
+    # 100 tokens per second, the default max_tokens_per_request is way larger than the limit
+    texts = ["word " * 30] * 201
+    with StubEmbeddingServer() as server:
+        result = embed(server, texts, tmp_path, max_tokens_per_minute=6000)
+
+    assert server.num_calls == 2
+    np.testing.assert_array_equal(result["request_ids"], np.arange(201))
@@ -0,0 +1,234 @@
+import asyncio
+import subprocess
+import sys
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("fastapi")
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from dtw_inference_utils.scripts.gateway import create_app, wait_until_ready
+
+
+class StubBackend:
+    """OpenAI-like backend that answers with its name and counts the calls it got."""
+
+    def __init__(self, name: str, delay: float = 0.0):
+        self.name = name
+        self.delay = delay
+        self.healthy = True
+        self.num_calls = 0
+        self.release = None  # if set, requests wait for this event
+
+        app = web.Application()
+        app.router.add_get("/health", self.health)
+        app.router.add_post("/v1/chat/completions", self.chat)
+        self.server = TestServer(app)
+
+    @property
+    def url(self):
+        return str(self.server.make_url("")).rstrip("/")
+
+    async def health(self, request):
+        return web.Response(status=200 if self.healthy else 500)
+
+    async def chat(self, request):
+        self.num_calls += 1
+        body = await request.json()
+        if self.release is not None:
+            await self.release.wait()
+        await asyncio.sleep(self.delay)
+        if body.get("stream"):
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            await response.write(f"data: {self.name}\n\n".encode())
+            return response
+        return web.json_response({"backend": self.name, "echo": body})
+
+
+async def start_gateway(backends, **kwargs):
+    for backend in backends:
+        await backend.server.start_server()
+    app = create_app([backend.url for backend in backends], health_check_interval=3600, **kwargs)
+    gateway = app.state.gateway
+    await gateway.start()  # the ASGI transport does not run startup events
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://gateway")
+    return gateway, client
+
+
+async def stop_gateway(gateway, client, backends):
+    await client.aclose()
+    await gateway.stop()
+    for backend in backends:
+        await backend.server.close()
+
+
+def run(test):
+    """Run `test(gateway, client, backends)` against freshly started stub backends."""
+
+    def wrapper(backends, **kwargs):
+        async def main():
+            gateway, client = await start_gateway(backends, **kwargs)
+            try:
+                await test(gateway, client, backends)
+            finally:
+                await stop_gateway(gateway, client, backends)
+
+        asyncio.run(main())
+
+    return wrapper
+
+
+def test_least_loaded_routing():
+    @run
+    async def check(gateway, client, backends):
+        busy, idle = backends
+        busy.release = asyncio.Event()
+        gateway.backends[1].healthy = False  # force the first request to `busy`
+
+        first = asyncio.create_task(client.post("/v1/chat/completions", json={"x": 1}))
+        while busy.num_calls == 0:
+            await asyncio.sleep(0.01)
+        gateway.backends[1].healthy = True
+
+        second = await client.post("/v1/chat/completions", json={"x": 2})
+        assert second.json()["backend"] == "idle"
+
+        busy.release.set()
+        assert (await first).json()["backend"] == "busy"
+
+    check([StubBackend("busy"), StubBackend("idle")])
+
+
+def test_identical_requests_are_coalesced():
+    @run
+    async def check(gateway, client, backends):
+        responses = await asyncio.gather(
+            *[client.post("/v1/chat/completions", json={"x": 1}) for _ in range(5)]
+        )
+        assert [response.status_code for response in responses] == [200] * 5
+        assert len({response.text for response in responses}) == 1
+        assert sum(backend.num_calls for backend in backends) == 1
+
+    check([StubBackend("a", delay=0.2)])
+
+
+def test_different_api_keys_are_not_coalesced_or_cached():
+    @run
+    async def check(gateway, client, backends):
+        requests = [
+            client.post("/v1/chat/completions", json={"x": 1}, headers={"Authorization": f"Bearer key-{idx}"})
+            for idx in range(2)
+        ]
+        await asyncio.gather(*requests)
+        assert backends[0].num_calls == 2
+
+        await client.post("/v1/chat/completions", json={"x": 1}, headers={"Authorization": "Bearer key-0"})
+        assert backends[0].num_calls == 2  # cached for this key
+
+    check([StubBackend("a", delay=0.2)], cache_size=10)
+
+
+def test_coalesced_request_survives_cancelled_first_request():
+    @run
+    async def check(gateway, client, backends):
+        backend = backends[0]
+        backend.release = asyncio.Event()
+        body = b'{"x": 1}'
+        headers = {"content-type": "application/json"}
+
+        first = asyncio.create_task(gateway.handle("POST", "v1/chat/completions", body, headers))
+        while backend.num_calls == 0:
+            await asyncio.sleep(0.01)
+        second = asyncio.create_task(gateway.handle("POST", "v1/chat/completions", body, headers))
+        await asyncio.sleep(0.05)
+
+        first.cancel()
+        while backend.num_calls < 2:  # the second request is sent again
+            await asyncio.sleep(0.01)
+        backend.release.set()
+
+        response = await second
+        assert response.status_code == 200
+        assert first.cancelled()
+
+    check([StubBackend("a")])
+
+
+def test_cache_hit_and_eviction():
+    @run
+    async def check(gateway, client, backends):
+        backend = backends[0]
+        await client.post("/v1/chat/completions", json={"x": 1})
+        await client.post("/v1/chat/completions", json={"x": 1})
+        assert backend.num_calls == 1
+
+        await client.post("/v1/chat/completions", json={"x": 2})  # evicts x=1
+        await client.post("/v1/chat/completions", json={"x": 1})
+        assert backend.num_calls == 3
+
+    check([StubBackend("a")], cache_size=1)
+
+
+def test_unhealthy_backend_is_removed_from_rotation():
+    @run
+    async def check(gateway, client, backends):
+        sick, healthy = backends
+        sick.healthy = False
+        for _ in range(gateway.max_health_check_failures):
+            await gateway.check_health()
+
+        for idx in range(4):
+            response = await client.post("/v1/chat/completions", json={"x": idx})
+            assert response.json()["backend"] == "healthy"
+        assert sick.num_calls == 0
+
+        healthy.healthy = False
+        for _ in range(gateway.max_health_check_failures):
+            await gateway.check_health()
+        response = await client.post("/v1/chat/completions", json={"x": 5})
+        assert response.status_code == 503
+        assert "error" in response.json()
+
+    check([StubBackend("sick"), StubBackend("healthy")])
+
+
+def test_unreachable_backend_is_retried_on_another_one():
+    @run
+    async def check(gateway, client, backends):
+        dead, alive = backends
+        await dead.server.close()
+        gateway.backends[1].num_requests_in_flight = 1  # make the dead backend the first choice
+
+        response = await client.post("/v1/chat/completions", json={"x": 1})
+        assert response.json()["backend"] == "alive"
+        assert not gateway.backends[0].healthy
+
+    check([StubBackend("dead"), StubBackend("alive")])
+
+
+def test_streaming_passes_status_through():
+    @run
+    async def check(gateway, client, backends):
+        response = await client.post("/v1/chat/completions", json={"stream": True})
+        assert response.status_code == 200
+        assert response.text == "data: a\n\n"
+
+        backends[0].healthy = False
+        for _ in range(gateway.max_health_check_failures):
+            await gateway.check_health()
+        response = await client.post("/v1/chat/completions", json={"stream": True})
+        assert response.status_code == 503
+
+    check([StubBackend("a")])
+
+
+def test_wait_until_ready_fails_fast_on_crashed_backend():
+    process = subprocess.Popen([sys.executable, "-c", "import sys; sys.exit(3)"])
+    process.wait()
+    assert not asyncio.run(
+        wait_until_ready(["http://localhost:1"], timeout=60, poll_interval=0.1, processes=[process])
+    )
@@ -0,0 +1,72 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from dtw_inference_utils.requests.request import APIRequest
+from dtw_inference_utils.requests.status import ConcurrencyLimitStatus, StatusTracker
+
+
+def call_api(status_code: int, body: dict, tmp_path, attempts_left: int = 0, **kwargs):
+    """Send one request to a server that answers with `body` and `status_code`."""
+
+    async def handler(request):
+        return web.json_response(body, status=status_code)
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", handler)
+        server = TestServer(app)
+        await server.start_server()
+
+        status_tracker = StatusTracker(num_tasks_started=1, num_tasks_in_progress=1)
+        retry_queue = asyncio.Queue()
+        request = APIRequest(
+            task_id=0, request_json={"messages": []}, token_consumption=0, attempts_left=attempts_left,
+            metadata={"request_id": 0}
+        )
+        try:
+            async with aiohttp.ClientSession() as session:
+                await request.call_api(
+                    session=session,
+                    request_url=str(server.make_url("/v1/chat/completions")),
+                    request_header={},
+                    retry_queue=retry_queue,
+                    save_filepath=str(tmp_path / "results.jsonl"),
+                    status_tracker=status_tracker,
+                    **kwargs,
+                )
+        finally:
+            await server.close()
+        return status_tracker, retry_queue
+
+    return asyncio.run(main())
+
+
+def concurrency_limit_status():
+    status = ConcurrencyLimitStatus(initial_limit=16)
+    status.update_capacity(0)
+    return status
+
+
+def test_rate_limit_shrinks_concurrency_limit(tmp_path):
+    status = concurrency_limit_status()
+    status_tracker, _ = call_api(
+        429, {"error": {"message": "Rate limit reached"}}, tmp_path, concurrency_limit_status=status
+    )
+    assert status.limit < 16
+    assert status.num_requests_in_flight == 0
+    assert status_tracker.num_rate_limit_errors == 1
+
+
+def test_invalid_request_keeps_concurrency_limit(tmp_path):
+    status = concurrency_limit_status()
+    # the error format of vllm, without an "error" key
+    status_tracker, _ = call_api(
+        400, {"object": "error", "message": "prompt too long"}, tmp_path, concurrency_limit_status=status
+    )
+    assert status.limit == 16
+    assert status.num_requests_in_flight == 0
+    assert status_tracker.num_api_errors == 1
+    assert status_tracker.num_tasks_failed == 1
@@ -0,0 +1,28 @@
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("click")
+
+from dtw_inference_utils.scripts import serve
+
+
+def test_launch_backends_stops_started_replicas_on_failure(monkeypatch):
+    commands = iter([[sys.executable, "-c", "import time; time.sleep(60)"], ["/nonexistent/backend"]])
+    monkeypatch.setattr(serve, "build_backend_command", lambda *args: next(commands))
+
+    started = []
+    popen = subprocess.Popen
+
+    def record_popen(*args, **kwargs):
+        process = popen(*args, **kwargs)
+        started.append(process)
+        return process
+
+    monkeypatch.setattr(serve.subprocess, "Popen", record_popen)
+
+    with pytest.raises(FileNotFoundError):
+        serve.launch_backends("model", "OpenAI", 2, 8100, 0, True)
+    assert len(started) == 1
+    assert started[0].poll() is not None
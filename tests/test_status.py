@@ -0,0 +1,75 @@
+import pytest
+
+from dtw_inference_utils.requests.status import ConcurrencyLimitStatus
+
+
+def run_requests(status: ConcurrencyLimitStatus, num_requests: int, latency=1.0, **outcome):
+    """Keep the limit saturated and finish `num_requests` requests with the same outcome.
+
+    `latency` is either constant or a function of the number of requests in flight.
+    """
+    for _ in range(num_requests):
+        while status.is_capacity_available(0):
+            status.update_capacity(0)
+        request_latency = latency(status.num_requests_in_flight) if callable(latency) else latency
+        status.on_request_finished(request_latency, **outcome)
+
+
+def queueing_latency(num_slots: int):
+    """Latency of a backend serving `num_slots` requests at once, further requests wait in a queue."""
+    return lambda num_requests_in_flight: max(1.0, num_requests_in_flight / num_slots)
+
+
+def test_limit_grows_at_constant_latency():
+    status = ConcurrencyLimitStatus(initial_limit=16, max_limit=64)
+    run_requests(status, 2000)
+    assert status.limit == 64
+
+
+def test_limit_shrinks_when_latency_increases():
+    status = ConcurrencyLimitStatus(initial_limit=16)
+    run_requests(status, 500, latency=1.0)
+    saturated_limit = status.limit
+    run_requests(status, 500, latency=3.0)
+    assert status.limit < saturated_limit / 2
+
+
+def test_limit_recovers_after_overload_errors():
+    status = ConcurrencyLimitStatus(initial_limit=16)
+    run_requests(status, 50, error=True, overloaded=True)
+    assert status.limit == 1
+
+    run_requests(status, 2000)
+    assert status.limit > 16
+
+
+def test_other_errors_leave_limit_unchanged():
+    status = ConcurrencyLimitStatus(initial_limit=16)
+    run_requests(status, 50, error=True)
+    assert status.limit == 16
+    assert status.num_requests_in_flight == 15
+
+
+@pytest.mark.parametrize("num_slots", [64, 200])
+def test_limit_settles_near_capacity_of_queueing_backend(num_slots):
+    status = ConcurrencyLimitStatus(initial_limit=16)
+    run_requests(status, 20000, latency=queueing_latency(num_slots))
+    settled_limit = status.limit
+    assert num_slots <= settled_limit <= 1.5 * num_slots
+
+    # it holds there instead of creeping up with the latency
+    limits = []
+    for _ in range(20):
+        run_requests(status, 10000, latency=queueing_latency(num_slots))
+        limits.append(status.limit)
+    assert max(limits) <= 1.5 * num_slots
+    assert status.short_latency <= 1.5
+
+
+def test_limit_follows_slower_backend_after_probe():
+    status = ConcurrencyLimitStatus(initial_limit=16)
+    run_requests(status, 20000, latency=queueing_latency(64))
+    # e.g. longer prompts: latency doubles at any load, the baseline is measured again at the next probe
+    run_requests(status, 50000, latency=lambda num_requests_in_flight: 2 * max(1.0, num_requests_in_flight / 64))
+    assert status.baseline_latency == pytest.approx(2.0, rel=0.1)
+    assert 64 <= status.limit <= 1.5 * 64
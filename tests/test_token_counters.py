@@ -0,0 +1,103 @@
+import pytest
+
+from dtw_inference_utils.requests import token_counters
+from dtw_inference_utils.requests.token_counters import (
+    HuggingFaceTokenCounter,
+    TiktokenCounter,
+    get_token_counter,
+)
+
+CHAT_TEMPLATE = (
+    "{% for message in messages %}<s> {{ message['role'] }} {{ message['content'] }} {% endfor %}"
+    "{% if add_generation_prompt %}assistant{% endif %}"
+)
+MESSAGES = [
+    {"role": "system", "content": "be nice"},
+    {"role": "user", "content": "hello world"},
+]
+
+
+def save_tokenizer(path, chat_template=None):
+    """Save a whitespace word-level tokenizer, with "<s>" as BOS token, to `path`."""
+    pytest.importorskip("transformers")
+    if chat_template is not None:
+        pytest.importorskip("jinja2")
+    from tokenizers import Tokenizer, models, pre_tokenizers, processors
+    from transformers import PreTrainedTokenizerFast
+
+    vocab = {"[UNK]": 0, "<s>": 1, "system": 2, "user": 3, "assistant": 4, "hello": 5, "world": 6}
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer.post_processor = processors.TemplateProcessing(single="<s> $A", special_tokens=[("<s>", 1)])
+
+    hf_tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", unk_token="[UNK]")
+    hf_tokenizer.chat_template = chat_template
+    hf_tokenizer.save_pretrained(str(path))
+    return str(path)
+
+
+class FakeEncoding:
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture(autouse=True)
+def offline_tiktoken(monkeypatch):
+    # tiktoken downloads its encodings, which does not work offline
+    monkeypatch.setattr(token_counters.tiktoken, "get_encoding", lambda name: FakeEncoding())
+    get_token_counter.cache_clear()
+    yield
+    get_token_counter.cache_clear()
+
+
+def test_chat_template_is_counted_exactly(tmp_path):
+    counter = HuggingFaceTokenCounter(save_tokenizer(tmp_path, CHAT_TEMPLATE))
+
+    # "<s> system be nice <s> user hello world assistant", the template adds the BOS tokens itself
+    assert counter.num_tokens_from_messages(MESSAGES) == 9
+    prompt = counter.tokenizer.apply_chat_template(MESSAGES, tokenize=False, add_generation_prompt=True)
+    assert counter.num_tokens_from_messages(MESSAGES) == len(
+        counter.tokenizer.encode(prompt, add_special_tokens=False)
+    )
+
+
+def test_completion_prompt_includes_bos(tmp_path):
+    counter = HuggingFaceTokenCounter(save_tokenizer(tmp_path, CHAT_TEMPLATE))
+    assert counter.num_tokens("hello world") == 3
+
+
+def test_messages_without_chat_template_are_approximated(tmp_path):
+    counter = HuggingFaceTokenCounter(save_tokenizer(tmp_path))
+    assert counter.tokenizer.chat_template is None
+    # (BOS + 2 tokens + 4) per message + 2 for the reply
+    assert counter.num_tokens_from_messages(MESSAGES) == 2 * (3 + 4) + 2
+
+
+def test_chat_template_errors_are_approximated(tmp_path, caplog):
+    template = (
+        "{% if messages[0]['role'] == 'system' %}{{ raise_exception('System role not supported') }}{% endif %}"
+        + CHAT_TEMPLATE
+    )
+    counter = HuggingFaceTokenCounter(save_tokenizer(tmp_path, template))
+
+    assert counter.num_tokens_from_messages(MESSAGES[1:]) == 5  # "<s> user hello world assistant"
+    assert counter.num_tokens_from_messages(MESSAGES) == 2 * (3 + 4) + 2
+    assert "System role not supported" in caplog.text
+
+
+def test_token_counter_is_abstract():
+    with pytest.raises(TypeError):
+        token_counters.TokenCounter()
+
+
+def test_get_token_counter_dispatch(tmp_path):
+    assert isinstance(get_token_counter("cl100k_base"), TiktokenCounter)
+
+    tokenizer_path = save_tokenizer(tmp_path, CHAT_TEMPLATE)
+    counter = get_token_counter(tokenizer_path)
+    assert isinstance(counter, HuggingFaceTokenCounter)
+    assert get_token_counter(tokenizer_path) is counter  # loaded only once
+
+
+def test_get_token_counter_falls_back_to_tiktoken(tmp_path):
+    assert isinstance(get_token_counter(str(tmp_path / "missing")), TiktokenCounter)